@@ -7,13 +7,21 @@ via HTTP, this extension instead watches for push requests to non-existent
 repositories and prompts the (duely authorized) user to create it.  Following
 that the push continues as expected.'''
 
+import cProfile
+import itertools
+import os
+import re
 import shutil
 import tempfile
+import threading
+import time
 import unittest
 
 from mercurial.i18n import _
 from mercurial import hg, extensions, encoding, templater, wireproto, httppeer, ui
-from mercurial.hgweb import hgwebdir_mod, protocol
+from mercurial import commands, config, error, util
+from mercurial.node import nullid
+from mercurial.hgweb import hgweb_mod, hgwebdir_mod, protocol
 from mercurial.hgweb.common import ErrorResponse, HTTP_UNAUTHORIZED
 from mercurial.hgweb.common import HTTP_METHOD_NOT_ALLOWED, HTTP_FORBIDDEN
 
@@ -28,12 +36,27 @@ def should_create_repo(obj, req):
     virtual = req.env.get("PATH_INFO", "").strip('/')
     
     # is this a request for a (non-existent) repo?
-    if virtual.startswith('static/') or 'static' in req.form:
+    if 'static' in req.form:
         return False
+
+    verdict, reason = check_create_path(obj, virtual)
+    return verdict == 'ok'
+
+def check_create_path(obj, virtual):
+    '''Determine whether a repository could be created at the given virtual
+    path.  Returns a (verdict, reason) tuple where verdict is one of 'ok',
+    'invalid', 'exists' or 'outside'.  Only the hgwebdir's already scanned
+    repository list and configuration are consulted - the file system is not
+    touched.'''
+    virtual = virtual.strip('/')
+
+    # is this a request for a (non-existent) repo?
+    if virtual.startswith('static/'):
+        return 'invalid', 'static resource path'
     
     # this is a request for the top level index?
     if not virtual:
-        return False
+        return 'invalid', 'top level index'
     
     # is this a request for nested repos and hgwebs?
     repos = dict(obj.repos)
@@ -41,7 +64,7 @@ def should_create_repo(obj, req):
     while virtualrepo:
         real = repos.get(virtualrepo)
         if real:
-            return False
+            return 'exists', 'repository exists at %s' % virtualrepo
         up = virtualrepo.rfind('/')
         if up < 0:
             break
@@ -50,25 +73,26 @@ def should_create_repo(obj, req):
     # is this a request for subdirectories?
     subdir = virtual + '/'
     if [r for r in repos if r.startswith(subdir)]:
-        return False
+        return 'exists', 'path contains repositories'
 
     # Check to ensure requested path is within configured collections.
     paths = {}
     for name, value in obj.ui.configitems('paths'):
         paths[name] = value
     if not path_is_in_collection(virtual, paths):
-        return False
+        return 'outside', 'path is not within a collection'
 
     # If we've made it this far then it makes sense to create a repo
-    return True
+    return 'ok', ''
 
 class emptyrepo(object):
     '''Provide an empty repo for basic protocol methods.  Basically just retains
     a ui object.'''
-    def __init__(self, baseui=None):
+    def __init__(self, baseui=None, webdir=None):
         if baseui == None:
             baseui = ui.ui()
         self.ui = baseui
+        self.webdir = webdir
         self.requirements = set()
         self.supportedformats = set()
     def filtered(self, *args, **kwargs):
@@ -85,6 +109,13 @@ def hgwebinit_run_wsgi_wrapper(orig, obj, req):
         ctype = templater.stringify(ctype)
         
         obj.refresh()
+        maybe_reap(obj)
+
+        # caninit is read-only and answers for any path, existing or not.
+        cmd = req.form.get('cmd', [''])[0]
+        if cmd == 'caninit' and protocol.iscmd(cmd):
+            repo = emptyrepo(baseui=obj.ui, webdir=obj)
+            return protocol.call(repo, req, cmd)
         
         # Do our stuff...
         if should_create_repo(obj, req):
@@ -97,17 +128,22 @@ def hgwebinit_run_wsgi_wrapper(orig, obj, req):
                     paths[name] = value
                  
                 local = local_path_for_repo(virtual, paths)
+                cmd = req.form.get('cmd', [''])[0]
                 
-                if obj.ui.configbool('web', 'implicit_init', False):
+                # Find out what the client wants.  These commands are answered
+                # without a repo, even with implicit_init: init and
+                # initunbundle create it themselves (so that initunbundle can
+                # remove it again if the bundle is not applied).
+                if protocol.iscmd(cmd) and cmd in ('capabilities', 'init',
+                                                   'initunbundle'):
+                    repo = emptyrepo(baseui=obj.ui)
+                    # force refresh so the new repo is picked up
+                    obj.lastrefresh = 0
+                    return protocol.call(repo, req, cmd)
+                elif obj.ui.configbool('web', 'implicit_init', False):
                     # Go ahead and init if implicit creation is enabled
-                    hg.repository(obj.ui, path=local, create=True)
-                else:
-                    # Find out what the client wants.
-                    # Only the capabilities and init commands are supported.
-                    cmd = req.form.get('cmd', [''])[0]
-                    if protocol.iscmd(cmd) and cmd in ('capabilities', 'init'):
-                        repo = emptyrepo(baseui=obj.ui)
-                        return protocol.call(repo, req, cmd)
+                    create_repo(obj.ui, local, virtual,
+                                req.env.get('REMOTE_USER'))
                 
                 # force refresh
                 obj.lastrefresh = 0    
@@ -119,6 +155,72 @@ def hgwebinit_run_wsgi_wrapper(orig, obj, req):
     # Now hand off the request to the next handler (likely hgwebdir_mod)
     return orig(obj, req)
 
+# Http peers whose creation was deferred while a clone is running (see hg_clone)
+pendinginit = None
+
+def hg_clone(orig, *args, **kwargs):
+    '''A wrapper for hg.clone.  A clone to a new remote repository pushes right
+    after creating it so http_peer_instance may defer the creation to that
+    push.  Any repository still not created once the clone is done (there was
+    nothing to push) is created here.'''
+    global pendinginit
+    # Clones nest (subrepos) so keep the outer clone's peers around
+    previous, pendinginit = pendinginit, []
+    try:
+        result = orig(*args, **kwargs)
+        for inst in pendinginit:
+            if getattr(inst, 'finishinit', None):
+                inst.finishinit()
+    finally:
+        pendinginit = previous
+    return result
+
+def deferinitpeer(base):
+    '''Returns a subclass of the given http peer class for a repository that
+    has not been created yet.  Discovery is answered locally as for an empty
+    repository and the first push is sent as 'initunbundle' so that the
+    repository is created and filled in a single request.'''
+    class initpeer(base):
+        def heads(self):
+            return [nullid]
+
+        def known(self, nodes):
+            return [False] * len(nodes)
+
+        def branchmap(self):
+            return {}
+
+        def listkeys(self, namespace):
+            return {}
+
+        def _callpush(self, cmd, cg, **args):
+            if cmd != 'unbundle':
+                return base._callpush(self, cmd, cg, **args)
+
+            ret, output = base._callpush(self, 'initunbundle', cg, **args)
+            try:
+                applied = int(ret)
+            except ValueError:
+                applied = 0
+            if applied:
+                # The repo exists now so talk to it as usual
+                self.__class__ = base
+            else:
+                # The server removed the repo again.  Keep answering the rest
+                # of the push locally rather than asking a missing repo.
+                self.initfailed = True
+            return ret, output
+
+        def finishinit(self):
+            '''Creates the repository on its own if nothing was pushed.'''
+            if getattr(self, 'initfailed', False):
+                raise util.Abort(_('push failed, the remote repository was '
+                                   'not created'))
+            self._call('init')
+            self.__class__ = base
+
+    return initpeer
+
 def http_peer_instance(orig, ui, path, create):
     '''A wrapper for hg.httppeer.instance that supports creating repositories.'''
     if create:
@@ -127,7 +229,12 @@ def http_peer_instance(orig, ui, path, create):
         else:
             inst = httppeer.httppeer(ui, path)
         inst.requirecap('init', _('repo init'))
-        inst._call('init')
+        if pendinginit is not None and inst.capable('initunbundle'):
+            # A push follows so the repo is created along with it
+            inst.__class__ = deferinitpeer(inst.__class__)
+            pendinginit.append(inst)
+        else:
+            inst._call('init')
     else:
         inst = orig(ui, path, create)
     
@@ -143,7 +250,117 @@ def hgproto_init(repo, proto):
         paths[name] = value
      
     local = local_path_for_repo(virtual, paths)
-    hg.repository(repo.ui, path=local, create=True)
+    create_repo(repo.ui, local, virtual, proto.req.env.get('REMOTE_USER'))
+
+def hgproto_initunbundle(repo, proto, heads):
+    '''An hg protocol command handler that creates a new repository and
+    applies the attached bundle to it, just like 'unbundle'.  This gets bound
+    to the 'initunbundle' command.  If the bundle is not applied the new
+    repository is removed again.'''
+    if proto.req.env.get('REQUEST_METHOD') != 'POST':
+        raise ErrorResponse(HTTP_METHOD_NOT_ALLOWED,
+                            'push requires POST request')
+
+    # A real repo means it existed already, so it is not ours to remove
+    local = None
+    if isinstance(repo, emptyrepo):
+        virtual = proto.req.env.get("PATH_INFO", "").strip('/')
+
+        paths = {}
+        for name, value in repo.ui.configitems('paths'):
+            paths[name] = value
+
+        local = local_path_for_repo(virtual, paths)
+        repo = create_repo(repo.ui, local, virtual,
+                           proto.req.env.get('REMOTE_USER'))
+
+        # unbundle redirects proto.ui so that output from the new repo (hooks,
+        # addchangegroup) goes to the client rather than the server's stdout
+        proto.ui = repo.ui
+
+    applied = False
+    try:
+        result = wireproto.unbundle(repo, proto, heads)
+        applied = isinstance(result, wireproto.pushres) and result.res
+        return result
+    finally:
+        if local is not None and not applied:
+            remove_new_repo(repo, local)
+
+def remove_new_repo(repo, local):
+    '''Removes a repository created for a push that was not applied.  The
+    repository is locked while it is checked and removed: it may already be
+    visible to other clients, and if one of them pushed into it meanwhile it
+    is kept.  Returns True if the repository was removed.'''
+    try:
+        lock = repo.lock()
+    except error.LockError, inst:
+        repo.ui.warn(_('hgwebinit: could not remove %s: %s\n') % (local, inst))
+        return False
+
+    try:
+        if len(repo):
+            return False
+        try:
+            shutil.rmtree(local)
+        except OSError, inst:
+            repo.ui.warn(_('hgwebinit: could not remove %s: %s\n')
+                         % (local, inst))
+            return False
+        return True
+    finally:
+        try:
+            lock.release()
+        except (IOError, OSError):
+            # The store went away along with the repository
+            pass
+
+def hgproto_caninit(repo, proto, others):
+    '''An hg protocol command handler that reports whether repositories could
+    be created without creating them.  This gets bound to the 'caninit'
+    command.  The optional 'paths' argument holds newline separated virtual
+    paths; without it the request path is checked.  One line is returned per
+    path (see encode_caninit).'''
+    req = proto.req
+    if others.get('paths'):
+        virtuals = [p for p in others['paths'].split('\n') if p]
+    else:
+        virtuals = [req.env.get("PATH_INFO", "")]
+
+    webdir = getattr(repo, 'webdir', None)
+
+    # Permission does not depend on the path so only check it once.  Users who
+    # may not create learn nothing about the paths, not even what exists.
+    try:
+        create_allowed(repo.ui, req)
+    except ErrorResponse, err:
+        denied = err.message or 'create not authorized'
+        results = [(v.strip('/'), 'denied', denied) for v in virtuals]
+        return encode_caninit(results)
+
+    results = []
+    for virtual in virtuals:
+        if webdir is None:
+            verdict, reason = 'invalid', 'no repository collections'
+        else:
+            verdict, reason = check_create_path(webdir, virtual)
+        results.append((virtual.strip('/'), verdict, reason))
+
+    return encode_caninit(results)
+
+def encode_caninit(results):
+    '''Encodes (path, verdict, reason) tuples as the caninit response: one tab
+    separated line per path.'''
+    return ''.join('%s\t%s\t%s\n' % r for r in results)
+
+def decode_caninit(data):
+    '''Decodes a caninit response into a list of (path, verdict, reason)
+    tuples.'''
+    results = []
+    for line in data.splitlines():
+        if line:
+            results.append(tuple(line.split('\t', 2)))
+    return results
 
 def hgproto_capabilities(orig, repo, proto):
     '''A wrapper for hg.wireproto.capabilities that splices in 'init' as a
@@ -151,24 +368,124 @@ def hgproto_capabilities(orig, repo, proto):
     is still possible for a client to get an error if the path is not supported.
     '''
     caps = orig(repo, proto)
-    caps = ' '.join((caps, 'init'))
+    caps = ' '.join((caps, 'init', 'caninit', 'initunbundle'))
     return caps
 
+def reap(ui, **opts):
+    '''remove abandoned repositories created by hgwebinit
+
+    Finds repositories served by the given hgweb configuration that were
+    created by hgwebinit but have not received a single changeset within the
+    grace period and removes them.  The grace period is given in seconds and
+    defaults to web.reap_grace (one day).  Repositories that are locked or
+    contain anything besides the .hg directory are left alone.'''
+    webconf = opts.get('web_conf')
+    if not webconf:
+        raise util.Abort(_('an hgweb configuration is required (--web-conf)'))
+
+    webdir = hgwebdir_mod.hgwebdir(webconf, baseui=ui)
+    grace = opts.get('grace')
+    if grace == '':
+        grace = webdir.ui.configint('web', 'reap_grace', 86400)
+    else:
+        try:
+            grace = int(grace)
+        except ValueError:
+            raise util.Abort(_('--grace must be a number of seconds'))
+
+    dryrun = opts.get('dry_run')
+    reaped = reap_abandoned(webdir.ui, webdir.repos, grace, dryrun=dryrun)
+    for virtual in reaped:
+        if dryrun:
+            ui.status(_('would remove %s\n') % virtual)
+        else:
+            ui.status(_('removed %s\n') % virtual)
+
+def checkformat(ui, **opts):
+    '''report repositories that deviate from their format profile
+
+    Checks each repository served by the given hgweb configuration that lies
+    in a collection with a format profile (see [format_profiles]) and lists
+    the format requirements it is missing (+) or has unexpectedly (-).
+    Returns 1 if any repository deviates, 0 otherwise.'''
+    webconf = opts.get('web_conf')
+    if not webconf:
+        raise util.Abort(_('an hgweb configuration is required (--web-conf)'))
+
+    webdir = hgwebdir_mod.hgwebdir(webconf, baseui=ui)
+
+    ret = 0
+    for virtual, local in webdir.repos:
+        try:
+            name, options = format_profile_for_path(webdir.ui, virtual)
+        except error.ConfigError, inst:
+            ui.warn(_('%s: %s\n') % (virtual, inst))
+            ret = 1
+            continue
+        if not options:
+            continue
+        try:
+            repo = hg.repository(webdir.ui, path=local)
+        except error.RepoError, inst:
+            ui.warn(_('%s: %s\n') % (virtual, inst))
+            continue
+
+        missing, unexpected = format_deviations(
+            apply_format_profile(webdir.ui, options), repo.requirements)
+        if missing or unexpected:
+            changes = ['+' + r for r in missing] + ['-' + r for r in unexpected]
+            ui.write('%s: %s %s\n' % (virtual, name, ' '.join(changes)))
+            ret = 1
+    return ret
+
+cmdtable = {
+    'reap': (reap,
+             [('', 'web-conf', '', _('name of the hgweb config file'),
+               _('FILE')),
+              ('', 'grace', '', _('seconds an empty repository is kept'),
+               _('SECONDS')),
+              ('n', 'dry-run', None, _('do not remove anything, just list'))],
+             _('hg reap --web-conf FILE [OPTION]...')),
+    'checkformat': (checkformat,
+                    [('', 'web-conf', '', _('name of the hgweb config file'),
+                      _('FILE'))],
+                    _('hg checkformat --web-conf FILE')),
+}
+commands.norepo += ' reap checkformat'
+
 def uisetup(ui):
     '''Hooks into hgwebdir_mod's run_wsgi method so that we can listen for
     requests.'''
+    run_wsgi = hgwebinit_run_wsgi_wrapper
+    init = hgproto_init
+    initunbundle = hgproto_initunbundle
+
+    # Only wrap the request path for profiling if it was asked for
+    profiler = setup_profiler(ui)
+    if profiler is not None:
+        run_wsgi = profiler.wrap(run_wsgi, lambda orig, obj, req: req)
+        init = profiler.wrap(init, lambda repo, proto: proto.req)
+        initunbundle = profiler.wrap(initunbundle,
+                                     lambda repo, proto, heads: proto.req)
+
     # wrap hgwebdir_mod so that we can handle creation
-    extensions.wrapfunction(hgwebdir_mod.hgwebdir, 'run_wsgi', hgwebinit_run_wsgi_wrapper)
+    extensions.wrapfunction(hgwebdir_mod.hgwebdir, 'run_wsgi', run_wsgi)
     
     # wrap up caps
     extensions.wrapfunction(wireproto, 'capabilities', hgproto_capabilities)
     
     # Need to reset the capabilities command to use our newly set up wrapper    
     wireproto.commands['capabilities'] = (wireproto.capabilities, '')
-    wireproto.commands['init'] = (hgproto_init, '')
+    wireproto.commands['init'] = (init, '')
+    wireproto.commands['caninit'] = (hgproto_caninit, '*')
+    wireproto.commands['initunbundle'] = (initunbundle, 'heads')
+
+    # pushing to an existing repo (implicit_init) needs push permission
+    hgweb_mod.perms['initunbundle'] = 'push'
 
     # wrap http client to include ability to create
     extensions.wrapfunction(httppeer, 'instance', http_peer_instance) 
+    extensions.wrapfunction(hg, 'clone', hg_clone)
 
 def create_allowed(ui, req):
     '''Check allow_create and deny_create config options of a repo's ui object
@@ -257,24 +574,8 @@ def path_is_in_collection(path, conf_paths):
     @param conf_paths: A dictionary of virtual-paths to local filesystem paths.
     '''
     
-    # Assume some root path (since the config is written that way)
-    if path[0] != '/':
-        path = '/' + path
-    
-    # Check the path against each configured path.
-    for virt in conf_paths:
-        local = conf_paths[virt]
-        
-        # Skip if this configured path is not a collection
-        if not (local.endswith('**') or local.endswith('*')):
-            continue
-        
-        # Check if the path is in this collection
-        if path.startswith(virt):
-            return True
-      
-    # After checking all the configured collections, there was no match  
-    return False
+    # Match the same way the format profile lookup does
+    return collection_for_path(path, conf_paths) is not None
 
 def local_path_for_repo(path, conf_paths):
     '''Determines the local file system path based on a given virtual (url) path
@@ -284,31 +585,376 @@ def local_path_for_repo(path, conf_paths):
     if path[0] != '/':
         path = '/' + path
     
+    # Find the deepest configured path containing this one, matching whole
+    # path segments only (like collection_for_path)
+    found = None
     for virt in conf_paths:
         local = conf_paths[virt]
         
         # We can't put a repo at the root of a collection
-        if local.endswith('*') and path == virt:
+        root = virt.rstrip('/')
+        if local.endswith('*') and path.rstrip('/') == root:
             continue
         
-        # Let's not confuse collection paths
-        if local.endswith('**'):
-            local = local[:-3]
-        elif local.endswith('*'):
-            local = local[:-2]
+        if not (path == root or path.startswith(root + '/')):
+            continue
         
-        # Return the local path for the virtual one
-        # Basically just remove the collection root from the virtual path and
-        # replace it with the collection's local path
-        if path.startswith(virt):
-            p = os.path.normpath(path)
-            v = os.path.normpath(virt)
-            local = os.path.normpath(local)
-            l = p.replace(v, local, 1)
-            return l
-      
-    # After checking all the configured collections, there was no match  
-    return None
+        if found is None or len(virt) > len(found):
+            found = virt
+    
+    # After checking all the configured paths, there was no match
+    if found is None:
+        return None
+    
+    # Let's not confuse collection paths
+    local = conf_paths[found]
+    if local.endswith('**'):
+        local = local[:-3]
+    elif local.endswith('*'):
+        local = local[:-2]
+    
+    # Return the local path for the virtual one
+    # Basically just remove the collection root from the virtual path and
+    # replace it with the collection's local path
+    p = os.path.normpath(path)
+    v = os.path.normpath(found)
+    return os.path.normpath(os.path.normpath(local) + p[len(v):])
+
+# Requirements written at creation time along with the [format] option that
+# controls each of them and hg's default for that option.
+format_requirements = [
+    ('store', 'usestore', True),
+    ('fncache', 'usefncache', True),
+    ('dotencode', 'dotencode', True),
+    ('generaldelta', 'generaldelta', False),
+]
+
+def collection_for_path(path, conf_paths):
+    '''Returns the configured collection (virtual path) containing the given
+    path or None.  If collections are nested the deepest one wins.'''
+    if path[0] != '/':
+        path = '/' + path
+
+    found = None
+    for virt in conf_paths:
+        local = conf_paths[virt]
+
+        # Skip if this configured path is not a collection
+        if not (local.endswith('**') or local.endswith('*')):
+            continue
+
+        # Only match whole path segments: /trunk does not contain /trunk2/x
+        root = virt.rstrip('/')
+        if not (path == root or path.startswith(root + '/')):
+            continue
+
+        if found is None or len(virt) > len(found):
+            found = virt
+
+    return found
+
+def format_profile_for_path(ui, path):
+    '''Looks up the format profile for the collection containing path.  The
+    [format_profiles] section maps collections to profile names and each
+    profile is a [format_profile.NAME] section holding [format] options.
+    Returns a (name, options) tuple, or (None, None) if there is no profile.
+    A profile name without a section is a configuration error - creating the
+    repository with the default format instead would go unnoticed.'''
+    paths = {}
+    for name, value in ui.configitems('paths'):
+        paths[name] = value
+
+    collection = collection_for_path(path, paths)
+    if collection is None:
+        return None, None
+
+    profiles = dict(ui.configitems('format_profiles'))
+    name = profiles.get(collection)
+    if not name:
+        return None, None
+
+    options = ui.configitems('format_profile.%s' % name)
+    if not options:
+        raise error.ConfigError(_('format profile %s for %s is not defined '
+                                  '(no [format_profile.%s] section)')
+                                % (name, collection, name))
+    return name, options
+
+def apply_format_profile(ui, options):
+    '''Returns a copy of ui with the given [format] options set.'''
+    ui = ui.copy()
+    for name, value in options:
+        ui.setconfig('format', name, value)
+    return ui
+
+def expected_requirements(ui):
+    '''Returns the set of format requirements hg would write for a repository
+    created with the given ui.'''
+    expected = set()
+    for requirement, option, default in format_requirements:
+        if not ui.configbool('format', option, default):
+            continue
+        # fncache only applies to a store, dotencode only to fncache
+        if requirement == 'fncache' and 'store' not in expected:
+            continue
+        if requirement == 'dotencode' and 'fncache' not in expected:
+            continue
+        expected.add(requirement)
+    return expected
+
+def format_deviations(ui, requirements):
+    '''Compares a repository's requirements against those expected from ui.
+    Returns a (missing, unexpected) tuple of sorted requirement lists.'''
+    expected = expected_requirements(ui)
+    known = set(r for r, option, default in format_requirements)
+    actual = set(requirements) & known
+    return sorted(expected - actual), sorted(actual - expected)
+
+def create_repo(ui, local, virtual, user):
+    '''Creates a new repository at the given local path and records who
+    created it, when and for which virtual path in .hg/hgwebinit.  The record
+    is what allows abandoned repositories to be reaped later on.  If the
+    collection has a format profile it is applied to the new repository.'''
+    name, options = format_profile_for_path(ui, virtual)
+    if options:
+        ui = apply_format_profile(ui, options)
+
+    repo = hg.repository(ui, path=local, create=True)
+    fp = repo.opener('hgwebinit', 'w')
+    try:
+        fp.write('[created]\n')
+        fp.write('time = %d\n' % int(time.time()))
+        fp.write('user = %s\n' % (user or ''))
+        fp.write('path = %s\n' % virtual.strip('/'))
+    finally:
+        fp.close()
+    return repo
+
+def read_creation_info(local):
+    '''Returns the creation record written by create_repo as a dictionary, or
+    None if the repository at the local path was not created by hgwebinit.'''
+    path = os.path.join(local, '.hg', 'hgwebinit')
+    if not os.path.isfile(path):
+        return None
+
+    cfg = config.config()
+    try:
+        cfg.read(path)
+    except error.ParseError:
+        return None
+    info = dict(cfg.items('created'))
+    try:
+        info['time'] = int(info.get('time', ''))
+    except ValueError:
+        return None
+    return info
+
+def find_abandoned(ui, repos, grace, now=None):
+    '''Yields the (virtual, local) pairs from repos that were created by
+    hgwebinit more than grace seconds ago and still have no changesets.'''
+    if now is None:
+        now = time.time()
+
+    for virtual, local in repos:
+        info = read_creation_info(local)
+        if info is None or now - info['time'] < grace:
+            continue
+        try:
+            repo = hg.repository(ui, path=local)
+        except error.RepoError:
+            continue
+        if len(repo) == 0:
+            yield virtual, local
+
+def reap_repo(ui, local, dryrun=False):
+    '''Removes the empty repository at the given local path.  The repository
+    is locked first so that a push that is just starting is not clobbered and
+    everything is checked again under the lock.  Returns True if the
+    repository was removed (or, with dryrun, would have been).'''
+    try:
+        repo = hg.repository(ui, path=local)
+    except error.RepoError:
+        # Already gone, e.g. reaped by another process
+        return False
+    try:
+        wlock = repo.wlock(wait=False)
+    except error.LockHeld:
+        return False
+    lock = None
+    try:
+        try:
+            lock = repo.lock(wait=False)
+        except error.LockHeld:
+            return False
+
+        # Only ever remove a bare, empty repository that we created
+        if len(repo) or read_creation_info(local) is None:
+            return False
+        if os.listdir(local) != ['.hg']:
+            return False
+
+        if not dryrun:
+            shutil.rmtree(local)
+        return True
+    finally:
+        if lock is not None:
+            lock.release()
+        wlock.release()
+
+def reap_abandoned(ui, repos, grace, dryrun=False):
+    '''Removes abandoned repositories (see find_abandoned) and returns the
+    virtual paths of those removed.  With dryrun nothing is removed but the
+    same checks are made.'''
+    reaped = []
+    for virtual, local in list(find_abandoned(ui, repos, grace)):
+        if reap_repo(ui, local, dryrun=dryrun):
+            reaped.append(virtual)
+    return reaped
+
+# Guards the start of background sweeps (see maybe_reap)
+reaplock = threading.Lock()
+
+def maybe_reap(obj):
+    '''Starts a reaper sweep over the hgwebdir's repositories if
+    web.reap_interval is set and at least that many seconds have passed since
+    the last one.  The sweep opens every repository so it runs on a background
+    thread rather than holding up the request that happened to start it.'''
+    interval = obj.ui.configint('web', 'reap_interval', 0)
+    if not interval:
+        return
+
+    # Requests are served by several threads, only one may start the sweep
+    reaplock.acquire()
+    try:
+        now = time.time()
+        if (getattr(obj, 'reaping', False) or
+            now - getattr(obj, 'lastreap', 0) < interval):
+            return
+        obj.lastreap = now
+        obj.reaping = True
+    finally:
+        reaplock.release()
+
+    grace = obj.ui.configint('web', 'reap_grace', 86400)
+    sweep = threading.Thread(target=reap_sweep,
+                             args=(obj, list(obj.repos), grace))
+    sweep.setDaemon(True)
+    sweep.start()
+
+def reap_sweep(obj, repos, grace):
+    '''The body of the background sweep started by maybe_reap.'''
+    try:
+        try:
+            reaped = reap_abandoned(obj.ui, repos, grace)
+        except (OSError, IOError, util.Abort, error.RepoError,
+                error.LockError), inst:
+            obj.ui.warn(_('hgwebinit: reaper sweep failed: %s\n') % inst)
+            return
+
+        if reaped:
+            # force refresh
+            obj.lastrefresh = 0
+    finally:
+        obj.reaping = False
+
+class requestprofiler(object):
+    '''Runs a sampled fraction of calls under cProfile and writes the
+    profiles to a directory, keeping only the most recent ones.  Every
+    sample'th call of each wrapped function is profiled.  With a threshold
+    every call is profiled but only kept if it took at least threshold
+    seconds (or was sampled).'''
+    def __init__(self, ui, directory, sample=0, threshold=0.0, keep=50):
+        self.ui = ui
+        self.directory = directory
+        self.sample = sample
+        self.threshold = threshold
+        self.keep = keep
+        self.serial = itertools.count(1)
+        self.local = threading.local()
+
+    def wrap(self, func, getreq):
+        '''Returns func wrapped for profiling.  getreq is called with the same
+        arguments as func and returns the request used to tag the profile.'''
+        # Each function counts its own calls so that commands run within a
+        # request do not use up the request's sample slots
+        counter = itertools.count(1)
+        def profiled(*args, **kwargs):
+            sampled = self.sample and counter.next() % self.sample == 0
+
+            # Nested profilers would steal each other's events
+            if getattr(self.local, 'active', False) or not (sampled or
+                                                             self.threshold):
+                return func(*args, **kwargs)
+
+            prof = cProfile.Profile()
+            self.local.active = True
+            start = time.time()
+            try:
+                return prof.runcall(func, *args, **kwargs)
+            finally:
+                elapsed = time.time() - start
+                self.local.active = False
+                if sampled or elapsed >= self.threshold:
+                    self.dump(prof, getreq(*args, **kwargs), start)
+        return profiled
+
+    def dump(self, prof, req, start):
+        '''Writes the profile tagged with the request and rotates old ones.'''
+        # A request and the command it runs can finish in the same millisecond
+        serial = '%d.%d' % (os.getpid(), self.serial.next())
+        name = profile_filename(req.env.get('PATH_INFO', ''),
+                                req.form.get('cmd', [''])[0],
+                                req.env.get('REMOTE_USER'), start, serial)
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            prof.dump_stats(os.path.join(self.directory, name))
+            rotate_profiles(self.directory, self.keep)
+        except (IOError, OSError), inst:
+            self.ui.warn(_('hgwebinit: could not write profile: %s\n') % inst)
+
+def profile_filename(path, cmd, user, start, serial=''):
+    '''Builds the name of a profile dump from the time the request started and
+    its path, command and user.  Names sort in chronological order.  serial
+    keeps dumps started within the same millisecond apart.'''
+    stamp = time.strftime('%Y%m%d-%H%M%S', time.localtime(start))
+    stamp += '.%03d' % (int(start * 1000) % 1000)
+    if serial:
+        stamp += '-' + serial
+    tags = [stamp, cmd or 'none', user or 'anonymous',
+            path.strip('/') or 'index']
+    tags = [re.sub(r'[^A-Za-z0-9_.]+', '_', t) for t in tags]
+    return '-'.join(tags) + '.prof'
+
+def rotate_profiles(directory, keep):
+    '''Removes all but the newest keep profile dumps from directory.'''
+    dumps = sorted([f for f in os.listdir(directory) if f.endswith('.prof')])
+    for f in dumps[:max(len(dumps) - keep, 0)]:
+        os.unlink(os.path.join(directory, f))
+
+def setup_profiler(ui):
+    '''Returns a requestprofiler configured from the [web] section, or None if
+    neither web.profile_sample nor web.profile_threshold is set.  This is only
+    called from uisetup so the options have to be in an hgrc - the hgweb
+    configuration file is read too late.'''
+    sample = ui.configint('web', 'profile_sample', 0)
+    threshold = ui.config('web', 'profile_threshold', '')
+    if threshold:
+        try:
+            threshold = float(threshold)
+        except ValueError:
+            raise error.ConfigError(_('web.profile_threshold is not a number '
+                                      '(%r)') % threshold)
+    else:
+        threshold = 0.0
+
+    if not sample and not threshold:
+        return None
+
+    directory = ui.config('web', 'profile_dir',
+                          os.path.join(tempfile.gettempdir(), 'hgwebinit'))
+    keep = ui.configint('web', 'profile_keep', 50)
+    return requestprofiler(ui, directory, sample, threshold, keep)
 
 
 # Tests...
@@ -615,6 +1261,9 @@ class RepoDetectionTests(TempDirTestCase):
     def testSubRepoInCollection(self):
         self.assertTrue(self.checkInCollection('/trunk2/many/test1/newrepo'))
         
+    def testCollectionSegmentBoundary(self):
+        self.assertFalse(self.checkInCollection('/trunk2/shortcut/test1'))
+        
 class RepoPathCreationTests(TempDirTestCase):
     def setUp(self):
         TempDirTestCase.setUp(self)
@@ -653,6 +1302,20 @@ class RepoPathCreationTests(TempDirTestCase):
         import os.path
         self.assertEqual(os.path.join(self.tmprepo, 'test1', 'test2'), self.checkPath('/trunk1/test1/test2'))
         
+    def testSegmentBoundary(self):
+        self.assertEqual(None, self.checkPath('/trunk2/shortcut/test1'))
+        self.assertEqual(None, self.checkPath('/trunk1x/test1'))
+        
+    def testNestedCollection(self):
+        import os.path
+        nesteddir = self.make_temp_dir()
+        paths = dict(self.paths)
+        paths['/trunk2/short/nested'] = os.path.join(nesteddir, '*')
+        self.assertEqual(os.path.join(nesteddir, 'test1'),
+                         self.checkPath('/trunk2/short/nested/test1', paths))
+        self.assertEqual(os.path.join(self.collectiondir, 'test1'),
+                         self.checkPath('/trunk2/short/test1', paths))
+        
 class SubRepoTests(TempDirTestCase):
     def setUp(self):
         TempDirTestCase.setUp(self)
@@ -683,4 +1346,475 @@ class SubRepoTests(TempDirTestCase):
     
     def testPathAtRoot(self):
         self.assertFalse(path_is_subrepo('/', self.paths))
-        self.assertFalse(path_is_subrepo('/test1', self.paths))
\ No newline at end of file
+        self.assertFalse(path_is_subrepo('/test1', self.paths))
+
+class ProtoMock(object):
+    '''A simple Mock for hg's webproto object.  It only retains the request.'''
+    def __init__(self, req):
+        self.req = req
+
+class CanInitTests(TempDirTestCase):
+    '''Tests for the read-only caninit preflight command.'''
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+
+        import os.path
+
+        self.collectiondir = self.make_temp_dir()
+        self.tmprepo = self.make_temp_dir()
+
+        self.default_config = {
+            'web': {
+                'deny_create': ['deny_user'],
+                'allow_create': ['allow_user'],
+                'allow_push': '*'
+            },
+            'paths': {
+                '/trunk2/short' : os.path.join(self.collectiondir, '*'),
+                '/trunk1' : self.tmprepo
+            }
+        }
+        self.ui = UiMock(config=self.default_config)
+
+        self.mod = ModuleMock(self.ui)
+        self.mod.repos = [('trunk1', self.tmprepo),
+                          ('trunk2/short/existing', self.collectiondir)]
+
+    def caninit(self, user, paths=None, path_info='/trunk2/short/new'):
+        req = RequestMock(env={
+            'REMOTE_USER': user,
+            'REQUEST_METHOD': 'GET',
+            'wsgi.url_scheme': 'https',
+            'PATH_INFO': path_info
+        })
+        others = {}
+        if paths is not None:
+            others['paths'] = '\n'.join(paths)
+        repo = emptyrepo(baseui=self.ui, webdir=self.mod)
+        return decode_caninit(hgproto_caninit(repo, ProtoMock(req), others))
+
+    def testRequestPath(self):
+        self.assertEqual([('trunk2/short/new', 'ok', '')],
+                         self.caninit('allow_user'))
+
+    def testBatch(self):
+        results = self.caninit('allow_user', paths=[
+            '/trunk2/short/new',
+            '/trunk2/short/existing',
+            '/trunk1/sub',
+            '/elsewhere',
+            '/'])
+        self.assertEqual(['ok', 'exists', 'exists', 'outside', 'invalid'],
+                         [verdict for path, verdict, reason in results])
+
+    def testDenied(self):
+        results = self.caninit('deny_user', paths=['/trunk2/short/new',
+                                                   '/trunk1'])
+        self.assertEqual(('trunk2/short/new', 'denied', 'create not authorized'),
+                         results[0])
+        # Existing repos must not be revealed to users who may not create
+        self.assertEqual(('trunk1', 'denied', 'create not authorized'),
+                         results[1])
+
+    def testCheckDoesNotCreate(self):
+        import os
+        self.caninit('allow_user')
+        self.assertEqual([], os.listdir(self.collectiondir))
+
+    def testEncoding(self):
+        results = [('a/b', 'ok', ''), ('c', 'outside', 'not in\ta collection')]
+        self.assertEqual(results, decode_caninit(encode_caninit(results)))
+
+class ReaperTests(TempDirTestCase):
+    '''Tests for finding repositories abandoned after creation.'''
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        self.ui = UiMock()
+
+    def make_repo(self, created=None):
+        import os
+        local = self.make_temp_dir()
+        os.mkdir(os.path.join(local, '.hg'))
+        if created is not None:
+            fp = open(os.path.join(local, '.hg', 'hgwebinit'), 'w')
+            fp.write('[created]\ntime = %d\nuser = allow_user\n'
+                     'path = trunk/new\n' % created)
+            fp.close()
+        return local
+
+    def testReadCreationInfo(self):
+        info = read_creation_info(self.make_repo(created=1000))
+        self.assertEqual(1000, info['time'])
+        self.assertEqual('allow_user', info['user'])
+        self.assertEqual('trunk/new', info['path'])
+
+    def testNotCreatedByHgwebinit(self):
+        local = self.make_repo()
+        self.assertEqual(None, read_creation_info(local))
+        self.assertEqual([], list(find_abandoned(self.ui, [('old', local)], 0)))
+
+    def testWithinGracePeriod(self):
+        local = self.make_repo(created=1000)
+        self.assertEqual([], list(find_abandoned(self.ui, [('new', local)],
+                                                 grace=100, now=1050)))
+
+    def testMalformedRecord(self):
+        import os
+        local = self.make_repo()
+        fp = open(os.path.join(local, '.hg', 'hgwebinit'), 'w')
+        fp.write('[created\ntime = 1000\n')
+        fp.close()
+        self.assertEqual(None, read_creation_info(local))
+
+    def create(self):
+        import os
+        local = os.path.join(self.make_temp_dir(), 'new')
+        create_repo(ui.ui(), local, 'trunk/new', 'allow_user')
+        return local
+
+    def testFindAbandoned(self):
+        local = self.create()
+        self.assertEqual([('trunk/new', local)],
+                         list(find_abandoned(ui.ui(), [('trunk/new', local)],
+                                             grace=100, now=time.time() + 200)))
+
+    def testReapRepo(self):
+        import os
+        local = self.create()
+        self.assertTrue(reap_repo(ui.ui(), local))
+        self.assertFalse(os.path.exists(local))
+
+    def testReapKeepsWorkingFiles(self):
+        import os
+        local = self.create()
+        open(os.path.join(local, 'notes.txt'), 'w').close()
+        self.assertFalse(reap_repo(ui.ui(), local))
+        self.assertTrue(os.path.exists(local))
+
+    def testReapKeepsLockedRepo(self):
+        import os
+        local = self.create()
+        lock = hg.repository(ui.ui(), local).lock()
+        try:
+            self.assertFalse(reap_repo(ui.ui(), local))
+        finally:
+            lock.release()
+        self.assertTrue(os.path.exists(local))
+
+    def testReapAbandonedDryRun(self):
+        import os
+        local = self.create()
+        self.assertEqual(['trunk/new'],
+                         reap_abandoned(ui.ui(), [('trunk/new', local)],
+                                        grace=-1, dryrun=True))
+        self.assertTrue(os.path.exists(local))
+
+    def testDryRunSkipsWorkingFiles(self):
+        import os
+        local = self.create()
+        open(os.path.join(local, 'notes.txt'), 'w').close()
+        self.assertEqual([], reap_abandoned(ui.ui(), [('trunk/new', local)],
+                                            grace=-1, dryrun=True))
+
+    def testReapAlreadyRemoved(self):
+        import os
+        gone = self.create()
+        local = self.create()
+        repos = [('trunk/gone', gone), ('trunk/new', local)]
+        abandoned = list(find_abandoned(ui.ui(), repos, grace=-1))
+        shutil.rmtree(gone)
+
+        # One repo vanishing must not stop the others from being reaped
+        self.assertFalse(reap_repo(ui.ui(), gone))
+        self.assertTrue(reap_repo(ui.ui(), local))
+        self.assertEqual(2, len(abandoned))
+        self.assertFalse(os.path.exists(local))
+
+class FormatProfileTests(TempDirTestCase):
+    '''Tests for per-collection repository format profiles.'''
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+
+        self.ui = UiMock(config={
+            'paths': {
+                '/trunk' : '/repos/*',
+                '/trunk/binary' : '/binrepos/**',
+                '/trunk1' : '/repos/trunk1'
+            },
+            'format_profiles': {
+                '/trunk/binary' : 'bigfiles'
+            },
+            'format_profile.bigfiles': {
+                'generaldelta': True
+            }
+        })
+
+    def testCollectionForPath(self):
+        paths = self.ui.config['paths']
+        self.assertEqual('/trunk', collection_for_path('/trunk/test1', paths))
+        self.assertEqual('/trunk/binary',
+                         collection_for_path('/trunk/binary/test1', paths))
+        self.assertEqual(None, collection_for_path('/elsewhere/test1', paths))
+        self.assertEqual(None, collection_for_path('/trunk2/test1', paths))
+
+    def testProfileForPath(self):
+        name, options = format_profile_for_path(self.ui, 'trunk/binary/big')
+        self.assertEqual('bigfiles', name)
+        self.assertEqual([('generaldelta', True)], list(options))
+        self.assertEqual((None, None),
+                         format_profile_for_path(self.ui, 'trunk/small'))
+
+    def testUnknownProfile(self):
+        self.ui.config['format_profiles']['/trunk'] = 'missing'
+        self.assertRaises(error.ConfigError, format_profile_for_path,
+                          self.ui, 'trunk/small')
+
+    def testApplyProfile(self):
+        base = ui.ui()
+        applied = apply_format_profile(base, [('generaldelta', 'True'),
+                                              ('dotencode', 'False')])
+        self.assertTrue(applied.configbool('format', 'generaldelta'))
+        self.assertFalse(applied.configbool('format', 'dotencode', True))
+        # The server's own ui is left alone
+        self.assertFalse(base.configbool('format', 'generaldelta'))
+
+    def testCreateWithProfile(self):
+        import os
+        collectiondir = self.make_temp_dir()
+        base = ui.ui()
+        base.setconfig('paths', '/binary', os.path.join(collectiondir, '*'))
+        base.setconfig('format_profiles', '/binary', 'bigfiles')
+        base.setconfig('format_profile.bigfiles', 'generaldelta', 'True')
+        base.setconfig('format_profile.bigfiles', 'dotencode', 'False')
+
+        repo = create_repo(base, os.path.join(collectiondir, 'big'),
+                           'binary/big', 'allow_user')
+        self.assertTrue('generaldelta' in repo.requirements)
+        self.assertFalse('dotencode' in repo.requirements)
+
+    def testExpectedRequirements(self):
+        self.assertEqual(set(['store', 'fncache', 'dotencode']),
+                         expected_requirements(UiMock()))
+        ui = UiMock(config={'format': {'usefncache': False,
+                                       'generaldelta': True}})
+        self.assertEqual(set(['store', 'generaldelta']),
+                         expected_requirements(ui))
+
+    def testDeviations(self):
+        ui = UiMock(config={'format': {'generaldelta': True}})
+        self.assertEqual((['generaldelta'], []), format_deviations(ui,
+                         ['revlogv1', 'store', 'fncache', 'dotencode']))
+        self.assertEqual(([], []), format_deviations(ui,
+                         ['revlogv1', 'store', 'fncache', 'dotencode',
+                          'generaldelta']))
+        self.assertEqual(([], ['dotencode']), format_deviations(UiMock(
+                         config={'format': {'dotencode': False}}),
+                         ['revlogv1', 'store', 'fncache', 'dotencode']))
+
+class PeerMock(object):
+    '''A simple Mock for hg's http peer that records the commands sent.'''
+    def __init__(self):
+        self.calls = []
+        self.pushresult = '1'
+
+    def heads(self):
+        raise AssertionError('heads of a new repo should not be requested')
+
+    def _call(self, cmd, **args):
+        self.calls.append(cmd)
+        return ''
+
+    def _callpush(self, cmd, cg, **args):
+        self.calls.append(cmd)
+        return self.pushresult, ''
+
+class DeferInitPeerTests(unittest.TestCase):
+    '''Tests for combining the creation of a repo with the first push.'''
+    def setUp(self):
+        self.peer = PeerMock()
+        self.peer.__class__ = deferinitpeer(PeerMock)
+
+    def testDiscovery(self):
+        self.assertEqual([nullid], self.peer.heads())
+        self.assertEqual([False, False], self.peer.known(['a', 'b']))
+        self.assertEqual({}, self.peer.branchmap())
+        self.assertEqual({}, self.peer.listkeys('bookmarks'))
+        self.assertEqual([], self.peer.calls)
+
+    def testFirstPush(self):
+        self.peer._callpush('unbundle', None, heads='force')
+        self.assertEqual(['initunbundle'], self.peer.calls)
+
+        # Afterwards the peer talks to the now existing repo as usual
+        self.assertEqual(PeerMock, self.peer.__class__)
+        self.peer._callpush('unbundle', None, heads='force')
+        self.assertEqual(['initunbundle', 'unbundle'], self.peer.calls)
+
+    def testRejectedPush(self):
+        self.peer.pushresult = '0'
+        self.assertEqual(('0', ''),
+                         self.peer._callpush('unbundle', None, heads='force'))
+
+        # The server removed the repo so nothing may be asked of it
+        self.assertEqual({}, self.peer.listkeys('phases'))
+        self.assertEqual(['initunbundle'], self.peer.calls)
+        self.assertRaises(util.Abort, self.peer.finishinit)
+        self.assertEqual(['initunbundle'], self.peer.calls)
+
+    def testNothingPushed(self):
+        self.peer.finishinit()
+        self.assertEqual(['init'], self.peer.calls)
+        self.assertEqual(PeerMock, self.peer.__class__)
+
+class ProfilerTests(TempDirTestCase):
+    '''Tests for sampled profiling of the request path.'''
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        self.directory = self.make_temp_dir()
+        self.req = RequestMock(env={
+            'REMOTE_USER': 'allow_user',
+            'PATH_INFO': '/trunk/new repo'
+        }, form={'cmd': ['init']})
+
+    def dumps(self):
+        import os
+        return sorted(os.listdir(self.directory))
+
+    def testFilename(self):
+        name = profile_filename('/trunk/new repo', 'init', 'allow_user', 0)
+        self.assertTrue(name.endswith('-init-allow_user-trunk_new_repo.prof'))
+        name = profile_filename('/', '', None, 0)
+        self.assertTrue(name.endswith('-none-anonymous-index.prof'))
+
+    def testSample(self):
+        profiler = requestprofiler(UiMock(), self.directory, sample=2)
+        func = profiler.wrap(lambda x: x * 2, lambda x: self.req)
+        self.assertEqual(2, func(1))
+        self.assertEqual([], self.dumps())
+        self.assertEqual(4, func(2))
+        self.assertEqual(1, len(self.dumps()))
+        self.assertTrue(self.dumps()[0].endswith(
+            '-init-allow_user-trunk_new_repo.prof'))
+
+    def testSamplePerFunction(self):
+        profiler = requestprofiler(UiMock(), self.directory, sample=2)
+        inner = profiler.wrap(lambda: None, lambda: self.req)
+        def request():
+            inner()
+            inner()
+        outer = profiler.wrap(request, lambda: self.req)
+        outer()
+        # The inner calls do not count towards the outer samples
+        self.assertEqual(1, len(self.dumps()))
+        outer()
+        self.assertEqual(2, len(self.dumps()))
+
+    def testThreshold(self):
+        profiler = requestprofiler(UiMock(), self.directory, threshold=60.0)
+        func = profiler.wrap(lambda: None, lambda: self.req)
+        func()
+        self.assertEqual([], self.dumps())
+
+    def testRotate(self):
+        import os
+        for i in range(5):
+            open(os.path.join(self.directory, '%d.prof' % i), 'w').close()
+        open(os.path.join(self.directory, 'other'), 'w').close()
+        rotate_profiles(self.directory, 2)
+        self.assertEqual(['3.prof', '4.prof', 'other'], self.dumps())
+
+class InitUnbundleTests(TempDirTestCase):
+    '''Tests for creating a repo and applying a bundle in one request.'''
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+
+        import os
+
+        self.collectiondir = self.make_temp_dir()
+        self.local = os.path.join(self.collectiondir, 'new')
+        self.ui = ui.ui()
+        self.ui.setconfig('paths', '/trunk', os.path.join(self.collectiondir,
+                                                          '*'))
+        self.req = RequestMock(env={
+            'REMOTE_USER': 'allow_user',
+            'REQUEST_METHOD': 'POST',
+            'wsgi.url_scheme': 'https',
+            'PATH_INFO': '/trunk/new'
+        })
+
+        self.unbundle = wireproto.unbundle
+        self._on_teardown.append(self.restoreUnbundle)
+
+    def restoreUnbundle(self):
+        wireproto.unbundle = self.unbundle
+
+    def initunbundle(self, unbundle):
+        wireproto.unbundle = unbundle
+        proto = ProtoMock(self.req)
+        proto.ui = self.ui
+        return hgproto_initunbundle(emptyrepo(baseui=self.ui), proto, 'force')
+
+    def testApplied(self):
+        def unbundle(repo, proto, heads):
+            # Output of the new repo must reach the client
+            self.assertTrue(proto.ui is repo.ui)
+            return wireproto.pushres(1)
+        self.assertEqual(1, self.initunbundle(unbundle).res)
+        self.assertTrue(read_creation_info(self.local) is not None)
+
+    def testRejected(self):
+        import os
+        def unbundle(repo, proto, heads):
+            return wireproto.pushres(0)
+        self.assertEqual(0, self.initunbundle(unbundle).res)
+        self.assertFalse(os.path.exists(self.local))
+
+    def testUnsynced(self):
+        import os
+        def unbundle(repo, proto, heads):
+            return wireproto.pusherr('repository changed')
+        self.initunbundle(unbundle)
+        self.assertFalse(os.path.exists(self.local))
+
+    def testException(self):
+        import os
+        def unbundle(repo, proto, heads):
+            raise IOError('connection dropped')
+        self.assertRaises(IOError, self.initunbundle, unbundle)
+        self.assertFalse(os.path.exists(self.local))
+
+    def testPushedMeanwhile(self):
+        import os
+        def unbundle(repo, proto, heads):
+            # Another client found the new repo and pushed into it
+            open(os.path.join(self.local, 'a'), 'w').close()
+            repo[None].add(['a'])
+            repo.commit(text='a', user='other_user')
+            return wireproto.pushres(0)
+        self.initunbundle(unbundle)
+        self.assertTrue(os.path.exists(self.local))
+
+    def testGetRequest(self):
+        import os
+        self.req.env['REQUEST_METHOD'] = 'GET'
+        self.assertRaises(ErrorResponse, self.initunbundle, None)
+        self.assertFalse(os.path.exists(self.local))
+
+class NestedCloneTests(unittest.TestCase):
+    '''Tests for tracking deferred peers across nested clones.'''
+    def testNestedClone(self):
+        outer = PeerMock()
+        outer.__class__ = deferinitpeer(PeerMock)
+
+        def inner():
+            return 'inner'
+
+        def clone():
+            pendinginit.append(outer)
+            # e.g. a subrepo clone
+            self.assertEqual('inner', hg_clone(inner))
+            return 'outer'
+
+        self.assertEqual('outer', hg_clone(clone))
+        self.assertEqual(['init'], outer.calls)
+        self.assertEqual(None, pendinginit)